@@ -4,12 +4,13 @@ import cv2
 import tempfile
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import lru_cache
 import shutil
 
 import datajoint as dj
 
-from .utils.keypoint_matching import match_keypoints_to_bbox
+from .utils.keypoint_matching import match_keypoints_to_bbox_batch
 from .env import add_path
 
 if "custom" not in dj.config:
@@ -20,6 +21,54 @@ db_prefix = dj.config["custom"].get("database.prefix", "")
 schema = dj.schema(db_prefix + "pose_pipeline")
 
 
+def get_attach_tempdir(store="localattach"):
+    """Directory to write output files that will be inserted into an attach store
+
+    For a local file store this is a hidden directory in the store itself, so the
+    outputs are on the same filesystem and link_to_attach_store can hard link them.
+    Otherwise it returns None, which tempfile takes as the system temp directory.
+    """
+
+    try:
+        spec = dj.config["stores"][store]
+        if spec["protocol"] == "file":
+            path = os.path.join(spec["location"], ".tmp")
+            os.makedirs(path, exist_ok=True)
+            return path
+    except (OSError, KeyError, TypeError):
+        pass
+
+    return None
+
+
+def link_to_attach_store(filename, store="localattach"):
+    """Hard link a file to the location DataJoint will store it as an attachment
+
+    When the attach store is a local file store on the same filesystem, inserting
+    the file afterwards finds it already in place and skips copying the video.
+    Otherwise this does nothing and the insert copies it as usual.
+    """
+    from pathlib import Path
+    from datajoint.hash import uuid_from_file
+
+    try:
+        external = schema.external[store]
+        if external.spec["protocol"] != "file":
+            return
+
+        # same naming as ExternalTable.upload_attachment
+        name = os.path.basename(filename)
+        uuid = uuid_from_file(filename, init_string=name + "\0")
+        dest = Path(external._make_uuid_path(uuid, "." + name))
+        if dest.exists():
+            return
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.link(filename, dest)
+    except (OSError, KeyError, AttributeError, dj.DataJointError):
+        pass
+
+
 @schema
 class Video(dj.Manual):
     definition = """
@@ -47,16 +96,23 @@ class Video(dj.Manual):
     def get_robust_reader(key, return_cap=True):
         import subprocess
         import tempfile
+        from .utils.video_format import cached_video, open_video_capture, is_video_verified, mark_video_verified
 
-        # fetch video and place in temp directory
-        video = (Video & key).fetch1("video")
+        # give the caller a temp file of the (locally cached) video that they can remove. this is
+        # a hard link when the cache and temp directory share a filesystem, and otherwise a copy
         fd, outfile = tempfile.mkstemp(suffix=".mp4")
         os.close(fd)
-        shutil.move(video, outfile)
+        with cached_video(key) as video:
+            try:
+                os.remove(outfile)
+                os.link(video, outfile)
+            except OSError:
+                shutil.copyfile(video, outfile)
+            verified = is_video_verified(key)
 
         video = outfile
 
-        cap = cv2.VideoCapture(video)
+        cap = open_video_capture(video)
 
         # check all the frames are readable
         expected_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -65,18 +121,31 @@ class Video(dj.Manual):
         def compress(video):
             fd, outfile = tempfile.mkstemp(suffix=".mp4")
             print(f"Unable to read all the fails. Transcoding {video} to {outfile}")
-            subprocess.run(["ffmpeg", "-y", "-i", video, "-c:v", "libx264", "-b:v", "1M", outfile])
+            # only an intermediate for decoding, so favor encoding speed
+            subprocess.run(
+                [
+                    "ffmpeg", "-y", "-i", video,
+                    "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23", "-threads", "0",
+                    "-movflags", "+faststart",
+                    outfile,
+                ]
+            )
             os.close(fd)
             return outfile
 
-        for i in range(expected_frames):
-            ret, frame = cap.read()
-            if not ret or frame is None:
-                cap.release()
-
-                video = compress(video)
-                cap = cv2.VideoCapture(video)
-                break
+        # grab still decodes each frame, which detects corrupt frames, but skips
+        # converting it to BGR since the pixels are not needed. videos that were
+        # fully readable before are not checked again
+        if not verified:
+            for i in range(expected_frames):
+                if not cap.grab():
+                    cap.release()
+
+                    video = compress(video)
+                    cap = open_video_capture(video)
+                    break
+            else:
+                mark_video_verified(key)
 
         if return_cap:
             cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
@@ -101,30 +170,34 @@ class VideoInfo(dj.Computed):
 
     def make(self, key, override=False):
 
+        from .utils.video_format import cached_video, probe_video
+
         key = key.copy()
-        video, start_time = (Video & key).fetch1("video", "start_time")
+        start_time = (Video & key).fetch1("start_time")
+
+        with cached_video(key) as video:
+            fps, frames, width, height = probe_video(video)
+        key["fps"] = fps
+        key["num_frames"] = frames
+        key["width"] = width
+        key["height"] = height
 
-        cap = cv2.VideoCapture(video)
-        key["fps"] = fps = cap.get(cv2.CAP_PROP_FPS)
         if (key["fps"] < 1):
-            cap.release()
             raise Exception("FPS is less than 1")
 
-        key["num_frames"] = frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        key["width"] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        key["height"] = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        key["timestamps"] = [start_time + timedelta(0, i / fps) for i in range(frames)]
-        key["delta_time"] = [timedelta(0, i / fps).total_seconds() for i in range(frames)]
-
-        cap.release()
-        os.remove(video)
+        # offsets are rounded to microseconds to match the resolution of datetime
+        offsets = pd.to_timedelta(np.arange(frames) / fps, unit="s").round("us")
+        key["timestamps"] = (pd.Timestamp(start_time) + offsets).to_pydatetime().tolist()
+        # kept as a single array so the blob is one contiguous buffer, rather than one entry per frame
+        key["delta_time"] = np.arange(frames, dtype=np.float64) / fps
 
         self.insert1(key, allow_direct_insert=override)
 
     def fetch_timestamps(self):
         assert len(self) == 1, "Restrict to single entity"
         timestamps = self.fetch1("timestamps")
-        timestamps = np.array([(t - timestamps[0]).total_seconds() for t in timestamps])
+        timestamps = np.array(timestamps, dtype="datetime64[us]")
+        timestamps = (timestamps - timestamps[0]) / np.timedelta64(1, "s")
         return timestamps
 
 
@@ -271,10 +344,11 @@ class BottomUpVideo(dj.Computed):
                 image = draw_keypoints(image, keypoints[idx][person_idx], color=get_color(person_idx))
             return image
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         video_overlay(video, out_file_name, overlay_fn, downsample=1)
         os.close(fd)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -342,10 +416,11 @@ class BottomUpBridgingVideo(dj.Computed):
 
         overlay_fn = get_overlay_callback(boxes, keypoints2d, joint_edges)
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
         video_overlay(video, out_file_name, overlay_fn, downsample=1)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -368,12 +443,14 @@ class OpenPose(dj.Computed):
 
     def make(self, key):
 
+        from .utils.video_format import open_video_capture
+
         video = Video.get_robust_reader(key, return_cap=False)
 
-        cap = cv2.VideoCapture(video)
+        # the same capture is used to pick the network resolution and to parse the video
+        cap = open_video_capture(video)
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        cap.release()
         if width > height:
             params = {"model_pose": "BODY_25", "scale_number": 4, "scale_gap": 0.25, "net_resolution": "1008x-1"}
         else:
@@ -382,7 +459,9 @@ class OpenPose(dj.Computed):
         with add_path(os.path.join(os.environ["OPENPOSE_PATH"], "build/python")):
             from pose_pipeline.wrappers.openpose import openpose_parse_video
 
-            res = openpose_parse_video(video, face=False, hand=True, **params)
+            res = openpose_parse_video(cap, face=False, hand=True, **params)
+
+        cap.release()
 
         key["keypoints"] = [r["keypoints"] for r in res]
         key["pose_ids"] = [r["pose_ids"] for r in res]
@@ -418,10 +497,11 @@ class OpenPoseVideo(dj.Computed):
                 image = draw_keypoints(image, keypoints[idx][person_idx])
             return image
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         video_overlay(video, out_file_name, overlay_fn, downsample=1)
         os.close(fd)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -446,28 +526,34 @@ class BlurredVideo(dj.Computed):
         video = Video.get_robust_reader(key, return_cap=False)
         keypoints = (BottomUpPeople & key & 'bottom_up_method_name="OpenPose_HR"').fetch1("keypoints")
 
-        def overlay_callback(image, idx):
-            image = image.copy()
-            if keypoints[idx] is None:
-                return image
+        # precompute the circles to draw for every frame so the callback only draws
+        circles = {}
+        for idx, kp in enumerate(keypoints):
+            if kp is None or len(kp) == 0:
+                continue
 
-            found_noses = keypoints[idx][:, 0, -1] > 0.1
-            nose_positions = keypoints[idx][found_noses, 0, :2]
-            neck_positions = keypoints[idx][found_noses, 1, :2]
+            found_noses = kp[:, 0, -1] > 0.1
+            nose_positions = kp[found_noses, 0, :2]
+            neck_positions = kp[found_noses, 1, :2]
 
             radius = np.linalg.norm(neck_positions - nose_positions, axis=1)
-            radius = np.clip(radius, 10, 250)
+            radius = np.clip(radius, 10, 250).astype(int)
+            centers = nose_positions.astype(int)
+
+            circles[idx] = list(zip(map(tuple, centers.tolist()), radius.tolist()))
 
-            for i in range(nose_positions.shape[0]):
-                center = (int(nose_positions[i, 0]), int(nose_positions[i, 1]))
-                cv2.circle(image, center, int(radius[i]), (255, 255, 255), -1)
+        # video_overlay passes a freshly decoded frame, so it can be drawn on in place
+        def overlay_callback(image, idx):
+            for center, radius in circles.get(idx, []):
+                cv2.circle(image, center, radius, (255, 255, 255), -1)
 
             return image
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
         video_overlay(video, out_file_name, overlay_callback, downsample=1)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
         self.insert1(key)
 
@@ -516,49 +602,51 @@ class TrackingBbox(dj.Computed):
 
         video = Video.get_robust_reader(key, return_cap=False)
 
-        if (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "DeepSortYOLOv4":
+        tracking_method_name = (TrackingBboxMethodLookup & key).fetch1("tracking_method_name")
+
+        if tracking_method_name == "DeepSortYOLOv4":
             from pose_pipeline.wrappers.deep_sort_yolov4.parser import tracking_bounding_boxes
 
             tracks = tracking_bounding_boxes(video)
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") in "MMTrack_tracktor":
+        elif tracking_method_name in "MMTrack_tracktor":
             from pose_pipeline.wrappers.mmtrack import mmtrack_bounding_boxes
 
             tracks = mmtrack_bounding_boxes(video, "tracktor")
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "MMTrack_deepsort":
+        elif tracking_method_name == "MMTrack_deepsort":
             from pose_pipeline.wrappers.mmtrack import mmtrack_bounding_boxes
 
             tracks = mmtrack_bounding_boxes(video, "deepsort")
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "MMTrack_bytetrack":
+        elif tracking_method_name == "MMTrack_bytetrack":
             from pose_pipeline.wrappers.mmtrack import mmtrack_bounding_boxes
 
             tracks = mmtrack_bounding_boxes(video, "bytetrack")
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "MMTrack_qdtrack":
+        elif tracking_method_name == "MMTrack_qdtrack":
             from pose_pipeline.wrappers.mmtrack import mmtrack_bounding_boxes
 
             tracks = mmtrack_bounding_boxes(video, "qdtrack")
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "FairMOT":
+        elif tracking_method_name == "FairMOT":
             from pose_pipeline.wrappers.fairmot import fairmot_bounding_boxes
 
             tracks = fairmot_bounding_boxes(video)
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "TransTrack":
+        elif tracking_method_name == "TransTrack":
             from pose_pipeline.wrappers.transtrack import transtrack_bounding_boxes
 
             tracks = transtrack_bounding_boxes(video)
             key["tracks"] = tracks
 
-        elif (TrackingBboxMethodLookup & key).fetch1("tracking_method_name") == "TraDeS":
+        elif tracking_method_name == "TraDeS":
             from pose_pipeline.wrappers.trades import trades_bounding_boxes
 
             tracks = trades_bounding_boxes(video)
@@ -590,41 +678,63 @@ class TrackingBboxVideo(dj.Computed):
     def make(self, key):
 
         import matplotlib
-        from pose_pipeline.utils.visualization import video_overlay
+        from pose_pipeline.utils.video_format import probe_video
+        from pose_pipeline.utils.visualization import video_overlay_composite, WHITE_RGBA
 
         video = (BlurredVideo & key).fetch1("output_video")
         tracks = (TrackingBbox & key).fetch1("tracks")
 
         N = len(np.unique([t["track_id"] for track in tracks for t in track]))
-        colors = matplotlib.cm.get_cmap("hsv", lut=N)
-
-        def overlay_callback(image, idx):
-            image = image.copy()
-
-            for track in tracks[idx]:
-                c = colors(track["track_id"])
-                c = (int(c[0] * 255.0), int(c[1] * 255.0), int(c[2] * 255.0))
-
-                small = int(5e-3 * np.max(image.shape))
-                large = 2 * small
-
-                bbox = track["tlbr"]
-                cv2.rectangle(image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (255, 255, 255), large)
-                cv2.rectangle(image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), c, small)
-
+        colors = matplotlib.colormaps["hsv"].resampled(N)
+
+        # opaque RGBA color for each track id as used by cv2. ids beyond the colormap take the last color
+        color_lut = [tuple(c) + (255,) for c in (colors(np.arange(N))[:, :3] * 255.0).astype(np.uint8).tolist()]
+
+        # the line widths only depend on the frame size and the label size on the text and
+        # the frame height, so measure them once
+        _, _, width, height = probe_video(video)
+        small = int(5e-3 * max(height, width))
+        large = 2 * small
+        font_scale = 5.0e-3 * height
+        textsizes = {}
+
+        # integerize all of the overlay geometry once instead of per frame and coordinate.
+        # the box corners of each frame are also kept as polygons so the white outlines
+        # can be drawn with one call
+        overlays = [[] for _ in range(len(tracks))]
+        outlines = [None for _ in range(len(tracks))]
+        for idx, track_timestep in enumerate(tracks):
+            if len(track_timestep) == 0:
+                continue
+
+            tlbr = np.rint(np.stack([t["tlbr"] for t in track_timestep])).astype(np.int32)
+            outlines[idx] = list(tlbr[:, [[0, 1], [2, 1], [2, 3], [0, 3]]])
+            for track, bbox in zip(track_timestep, tlbr):
                 label = str(track["track_id"])
-                textsize = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, int(5.0e-3 * image.shape[0]), 4)[0]
+                if label not in textsizes:
+                    textsizes[label] = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, int(font_scale), 4)[0]
+                textsize = textsizes[label]
+
                 x = int((bbox[0] + bbox[2]) / 2 - textsize[0] / 2)
                 y = int((bbox[3] + bbox[1]) / 2 + textsize[1] / 2)
-                cv2.putText(image, label, (x, y), 0, 5.0e-3 * image.shape[0], (255, 255, 255), thickness=large)
-                cv2.putText(image, label, (x, y), 0, 5.0e-3 * image.shape[0], c, thickness=small)
+                c = color_lut[min(track["track_id"], N - 1)]
+                overlays[idx].append((c, label, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (x, y)))
 
-            return image
+        def overlay_callback(canvas, idx):
+            if outlines[idx] is not None:
+                cv2.polylines(canvas, outlines[idx], True, WHITE_RGBA, large)
+
+            for c, label, tl, br, org in overlays[idx]:
+                cv2.rectangle(canvas, tl, br, c, small)
 
-        fd, fname = tempfile.mkstemp(suffix=".mp4")
+                cv2.putText(canvas, label, org, 0, font_scale, WHITE_RGBA, thickness=large)
+                cv2.putText(canvas, label, org, 0, font_scale, c, thickness=small)
+
+        fd, fname = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
-        video_overlay(video, fname, overlay_callback, downsample=1)
+        video_overlay_composite(video, fname, overlay_callback, downsample=1)
 
+        link_to_attach_store(fname)
         key["output_video"] = fname
 
         self.insert1(key)
@@ -656,33 +766,34 @@ class PersonBbox(dj.Computed):
     def make(self, key):
 
         tracks = (TrackingBbox & key).fetch1("tracks")
-        keep_tracks = (PersonBboxValid & key).fetch1("keep_tracks")
-
-        def extract_person_track(tracks):
-            def process_timestamp(track_timestep):
-                valid = [t for t in track_timestep if t["track_id"] in keep_tracks]
-                if len(valid) == 1:
-                    return {"present": True, "bbox": valid[0]["tlhw"]}
-                else:
-                    return {"present": False, "bbox": [0.0, 0.0, 0.0, 0.0]}
-
-            return [process_timestamp(t) for t in tracks]
-
-        LD = main_track = extract_person_track(tracks)
-        dict_lists = {k: [dic[k] for dic in LD] for k in LD[0]}
-
-        present = np.array(dict_lists["present"])
-        bbox = np.array(dict_lists["bbox"])
-
-        # smooth any brief missing frames
-        df = pd.DataFrame(bbox)
-        df.iloc[~present] = np.nan
-        df = df.fillna(method="bfill", axis=0, limit=2)
-        df = df.fillna(method="ffill", axis=0, limit=2)
+        keep_tracks = set((PersonBboxValid & key).fetch1("keep_tracks"))
+
+        # single pass over the tracks filling the bounding box for the person
+        present = np.zeros(len(tracks), dtype=bool)
+        bbox = np.zeros((len(tracks), 4), dtype=np.float64)
+        for idx, track_timestep in enumerate(tracks):
+            valid = [t for t in track_timestep if t["track_id"] in keep_tracks]
+            if len(valid) == 1:
+                present[idx] = True
+                bbox[idx] = valid[0]["tlhw"]
+
+        # smooth any brief missing frames. missing frames up to two before the next
+        # detection are filled from it, and then any still missing up to two after the
+        # previous detection from that (a bfill then ffill with limit=2)
+        idx = np.arange(len(tracks))
+        prev_idx = np.maximum.accumulate(np.where(present, idx, -1))
+        next_idx = np.minimum.accumulate(np.where(present, idx, len(tracks))[::-1])[::-1]
+
+        bfill = ~present & (next_idx < len(tracks)) & (next_idx - idx <= 2)
+        ffill = ~present & ~bfill & (prev_idx >= 0) & (idx - prev_idx <= 2)
+
+        bbox[~present] = np.nan
+        bbox[bfill] = bbox[next_idx[bfill]]
+        bbox[ffill] = bbox[prev_idx[ffill]]
 
         # get smoothed version
-        key["present"] = ~df.isna().any(axis=1).values
-        key["bbox"] = df.values
+        key["present"] = present | bfill | ffill
+        key["bbox"] = bbox
 
         self.insert1(key)
 
@@ -729,34 +840,38 @@ class DetectedFrames(dj.Computed):
 
         # compute statistics
         tracks = (TrackingBbox & key).fetch1("tracks")
-        keep_tracks = (PersonBboxValid & key).fetch1("keep_tracks")
-
-        def extract_person_stats(tracks):
-            def process_timestamp(track_timestep):
-                valid = [t for t in track_timestep if t["track_id"] in keep_tracks]
-                total_tracks = len(track_timestep)
-                if len(valid) == 1:
-                    if "confidence" in valid[0].keys():
-                        return {"present": True, "confidence": valid[0]["confidence"], "others": total_tracks - 1}
-                    else:
-                        return {"present": True, "confidence": 1.0, "others": total_tracks - 1}
+        keep_tracks = set((PersonBboxValid & key).fetch1("keep_tracks"))
+
+        def process_timestamp(track_timestep):
+            valid = [t for t in track_timestep if t["track_id"] in keep_tracks]
+            total_tracks = len(track_timestep)
+            if len(valid) == 1:
+                if "confidence" in valid[0].keys():
+                    return {"present": True, "confidence": valid[0]["confidence"], "others": total_tracks - 1}
                 else:
-                    return {"present": False, "confidence": 0, "others": total_tracks}
-
-            return [process_timestamp(t) for t in tracks]
-
-        stats = extract_person_stats(tracks)
-        present = np.array([x["present"] for x in stats])
+                    return {"present": True, "confidence": 1.0, "others": total_tracks - 1}
+            else:
+                return {"present": False, "confidence": 0, "others": total_tracks}
+
+        # collect the per frame statistics into arrays in the same pass
+        stats = []
+        present = np.zeros(len(tracks), dtype=bool)
+        confidence = np.zeros(len(tracks))
+        others = np.zeros(len(tracks), dtype=np.int32)
+        for idx, track_timestep in enumerate(tracks):
+            stat = process_timestamp(track_timestep)
+            stats.append(stat)
+            present[idx], confidence[idx], others[idx] = stat["present"], stat["confidence"], stat["others"]
 
         key["frames_detected"] = np.sum(present)
         key["frames_missed"] = np.sum(~present)
         key["fraction_found"] = key["frames_detected"] / (key["frames_missed"] + key["frames_detected"])
 
         if key["frames_detected"] > 0:
-            key["median_confidence"] = np.median([x["confidence"] for x in stats if x["present"]])
+            key["median_confidence"] = np.median(confidence[present])
         else:
             key["median_confidence"] = 0.0
-        key["mean_other_people"] = np.nanmean([x["others"] for x in stats])
+        key["mean_other_people"] = np.nanmean(others)
         key["frame_data"] = stats
 
         self.insert1(key)
@@ -773,11 +888,8 @@ class BestDetectedFrames(dj.Computed):
     """
 
     def make(self, key):
-        detected_frames = (DetectedFrames & key).fetch("fraction_found", "KEY", as_dict=True)
-
-        best = np.argmax([d["fraction_found"] for d in detected_frames])
-        res = detected_frames[best]
-        res.pop("fraction_found")
+        # let the database pick the entry with the most frames found, breaking ties by the key
+        res = (DetectedFrames & key).fetch("KEY", order_by=("fraction_found DESC", "KEY"), limit=1)[0]
         self.insert1(res)
 
     @property
@@ -802,9 +914,7 @@ class BottomUpPerson(dj.Computed):
         keypoints = (BottomUpPeople & key).fetch1("keypoints")
         bbox = (PersonBbox & key).fetch1("bbox")
 
-        res = [match_keypoints_to_bbox(bbox[idx], keypoints[idx]) for idx in range(bbox.shape[0])]
-        keypoints, _ = list(zip(*res))
-        keypoints = np.array(keypoints)
+        keypoints, _ = match_keypoints_to_bbox_batch(bbox, keypoints[: bbox.shape[0]])
         key["keypoints"] = keypoints
 
         self.insert1(key)
@@ -883,23 +993,20 @@ class OpenPosePerson(dj.Computed):
         keypoints, hand_keypoints = (OpenPose & key).fetch1("keypoints", "hand_keypoints")
         bbox = (PersonBbox & key).fetch1("bbox")
 
-        res = [match_keypoints_to_bbox(bbox[idx], keypoints[idx]) for idx in range(bbox.shape[0])]
-        keypoints, openpose_ids = list(zip(*res))
-
-        keypoints = np.array(keypoints)
+        keypoints, openpose_ids = match_keypoints_to_bbox_batch(bbox, keypoints[: bbox.shape[0]])
         openpose_ids = np.array(openpose_ids)
 
         key["keypoints"] = keypoints
         key["openpose_ids"] = openpose_ids
 
-        key["hand_keypoints"] = []
-
-        for openpose_id, hand_keypoint in zip(openpose_ids, hand_keypoints):
-            if openpose_id is None:
-                key["hand_keypoints"].append(np.zeros((2, 21, 3)))
-            else:
-                key["hand_keypoints"].append([hand_keypoint[0][openpose_id], hand_keypoint[1][openpose_id]])
-        key["hand_keypoints"] = np.asarray(key["hand_keypoints"])
+        # copy the hands of the matched person straight into the output, leaving
+        # unmatched frames as zeros
+        hands = np.zeros((len(openpose_ids), 2, 21, 3), dtype=np.float32)
+        for i, openpose_id in enumerate(openpose_ids):
+            if openpose_id is not None:
+                hands[i, 0] = hand_keypoints[i][0][openpose_id]
+                hands[i, 1] = hand_keypoints[i][1][openpose_id]
+        key["hand_keypoints"] = hands
 
         self.insert1(key)
 
@@ -945,27 +1052,21 @@ class OpenPosePersonVideo(dj.Computed):
 
     def make(self, key):
 
-        from pose_pipeline.utils.visualization import video_overlay, draw_keypoints
+        from pose_pipeline.utils.visualization import video_overlay_composite, draw_keypoints, WHITE_RGBA, BLACK_RGBA
 
         # fetch data
         keypoints, hand_keypoints = (OpenPosePerson & key).fetch1("keypoints", "hand_keypoints")
-        video_filename = (BlurredVideo & key).fetch1("output_video")
-
-        fd, fname = tempfile.mkstemp(suffix=".mp4")
-        os.close(fd)
-
         video = (BlurredVideo & key).fetch1("output_video")
-        keypoints = (OpenPosePerson & key).fetch1("keypoints")
 
-        def overlay(image, idx):
-            image = draw_keypoints(image, keypoints[idx])
-            image = draw_keypoints(image, hand_keypoints[idx, 0], threshold=0.02)
-            image = draw_keypoints(image, hand_keypoints[idx, 1], threshold=0.02)
-            return image
+        def overlay(canvas, idx):
+            draw_keypoints(canvas, keypoints[idx], color=WHITE_RGBA, border_color=BLACK_RGBA, copy=False)
+            for hand in hand_keypoints[idx]:
+                draw_keypoints(canvas, hand, threshold=0.02, color=WHITE_RGBA, border_color=BLACK_RGBA, copy=False)
 
-        ofd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        ofd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(ofd)
-        video_overlay(video, out_file_name, overlay, downsample=4)
+        video_overlay_composite(video, out_file_name, overlay, downsample=4)
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -1165,7 +1266,7 @@ class SkeletonActionVideo(dj.Computed):
     """
 
     def make(self, key):
-        from pose_pipeline.utils.visualization import video_overlay, draw_keypoints
+        from pose_pipeline.utils.visualization import video_overlay_composite, draw_keypoints, WHITE_RGBA, BLACK_RGBA
 
         video = (BlurredVideo & key).fetch1("output_video")
         keypoints = (TopDownPerson & key).fetch1("keypoints")
@@ -1176,11 +1277,11 @@ class SkeletonActionVideo(dj.Computed):
         top5_actions, stride = (SkeletonAction & key).fetch1("top5", "stride")
 
         def overlay_fn(image, idx):
-            image = draw_keypoints(image, keypoints[idx], radius=20, color=(0, 255, 0))
-            image = bbox_fn(image, idx, width=14, color=(0, 0, 255))
+            draw_keypoints(image, keypoints[idx], radius=20, color=(0, 255, 0, 255), border_color=BLACK_RGBA, copy=False)
+            bbox_fn(image, idx, width=14, color=(0, 0, 255, 255))
 
             if np.any(np.isnan(bbox[idx])):
-                return image
+                return
 
             top5 = top5_actions[min(len(top5_actions) - 1, idx // stride)]
 
@@ -1193,14 +1294,13 @@ class SkeletonActionVideo(dj.Computed):
                     textsize = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, fontsize, 4)[0]
 
                     coord = (int(top_left[0] + 5), int(top_left[1] + (10 + textsize[1]) * (1 + i)))
-                    cv2.putText(image, label, coord, 0, fontsize, (255, 255, 255), thickness=4)
+                    cv2.putText(image, label, coord, 0, fontsize, WHITE_RGBA, thickness=4)
 
-            return image
-
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
-        video_overlay(video, out_file_name, overlay_fn, downsample=1)
+        video_overlay_composite(video, out_file_name, overlay_fn, downsample=1)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -1247,29 +1347,31 @@ class LiftingPerson(dj.Computed):
 
     def make(self, key):
 
-        if (LiftingMethodLookup & key).fetch1("lifting_method_name") == "RIE":
+        lifting_method_name = (LiftingMethodLookup & key).fetch1("lifting_method_name")
+
+        if lifting_method_name == "RIE":
             from .wrappers.rie_lifting import process_rie
 
             results = process_rie(key)
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "GastNet":
+        elif lifting_method_name == "GastNet":
             from .wrappers.gastnet_lifting import process_gastnet
 
             with add_path(os.environ["GAST_PATH"]):
                 results = process_gastnet(key)
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "VideoPose3D":
+        elif lifting_method_name == "VideoPose3D":
             from .wrappers.videopose3d import process_videopose3d
 
             results = process_videopose3d(key)
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "PoseAug":
+        elif lifting_method_name == "PoseAug":
             from .wrappers.poseaug import process_poseaug
 
             results = process_poseaug(key)
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "PoseAug":
+        elif lifting_method_name == "PoseAug":
             from .wrappers.poseaug import process_poseaug
 
             results = process_poseaug(key)
 
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "Bridging_COCO_25":
+        elif lifting_method_name == "Bridging_COCO_25":
             from pose_pipeline.wrappers.bridging import filter_skeleton
             from pose_pipeline.utils.keypoints import keypoints_filter_clipped_image
 
@@ -1279,7 +1381,7 @@ class LiftingPerson(dj.Computed):
             # not capture this
             keypoints3d = keypoints_filter_clipped_image(key, keypoints3d)
             results = {"keypoints_3d": keypoints3d[:, :, :3], "keypoints_valid": keypoints3d[:, :, -1] > 0.5}
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "Bridging_bml_movi_87":
+        elif lifting_method_name == "Bridging_bml_movi_87":
             from pose_pipeline.wrappers.bridging import filter_skeleton
             from pose_pipeline.utils.keypoints import keypoints_filter_clipped_image
 
@@ -1289,7 +1391,7 @@ class LiftingPerson(dj.Computed):
             # not capture this
             keypoints3d = keypoints_filter_clipped_image(key, keypoints3d)
             results = {"keypoints_3d": keypoints3d[:, :, :3], "keypoints_valid": keypoints3d[:, :, -1] > 0.5}
-        elif (LiftingMethodLookup & key).fetch1("lifting_method_name") == "Bridging_smpl+head_30":
+        elif lifting_method_name == "Bridging_smpl+head_30":
             from pose_pipeline.wrappers.bridging import filter_skeleton
             from pose_pipeline.utils.keypoints import keypoints_filter_clipped_image
 
@@ -1343,7 +1445,7 @@ class LiftingPersonVideo(dj.Computed):
         keypoints_3d = (LiftingPerson & key).fetch1("keypoints_3d").copy()
         blurred_video = (BlurredVideo & key).fetch1("output_video")
         width, height, fps = (VideoInfo & key).fetch1("width", "height", "fps")
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
 
         with add_path(os.environ["GAST_PATH"]):
@@ -1393,6 +1495,7 @@ class LiftingPersonVideo(dj.Computed):
                 com_reconstrcution=False,
             )
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
         self.insert1(key)
 
@@ -1510,7 +1613,9 @@ class SMPLPerson(dj.Computed):
         self.insert1(res)
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def joint_names(model="smpl"):
+        # cached as the lookups import the body model packages (and PIXIE in its path)
         if model.upper() == "SMPL":
             from .utils.smpl import JOINT_NAMES_49
 
@@ -1527,6 +1632,7 @@ class SMPLPerson(dj.Computed):
             return pixie_joint_names
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def smpl_joint_names(model="smpl"):
         from smplx.joint_names import JOINT_NAMES
 
@@ -1539,7 +1645,7 @@ class SMPLPerson(dj.Computed):
         elif model == "PIXIE":
             # in addition to the dropped fields for smplx, Pixie also splits out the head and neck
             # into additional fields
-            return [j for j in JOINT_NAMES[:20] if j not in ["pelvis", "head", "neck"]]
+            return [j for j in JOINT_NAMES[:20] if j not in {"pelvis", "head", "neck"}]
         else:
             raise Exception("Unknown model type")
 
@@ -1583,17 +1689,19 @@ class SMPLPersonVideo(dj.Computed):
 
             callback = get_smpl_callback(key, poses, betas, cams)
 
-        # video = (BlurredVideo & key).fetch1("output_video")
-        video = (Video & key).fetch1("video")
+        from .utils.video_format import cached_video
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
-        video_overlay(video, out_file_name, callback, downsample=1)
+        # video = (BlurredVideo & key).fetch1("output_video")
+        with cached_video(key) as video:
+            video_overlay(video, out_file_name, callback, downsample=1)
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
 
-        os.remove(video)
+        os.remove(out_file_name)
 
 
 @schema
@@ -1617,13 +1725,45 @@ class CenterHMR(dj.Computed):
         # don't store verticies or images
         keys_to_keep = ["params", "pj2d", "j3d", "j3d_smpl24", "j3d_spin24", "j3d_op25"]
         res = [{k: v for k, v in r.items() if k in keys_to_keep} for r in res]
-        key["results"] = res
+        key["results"] = CenterHMR.results_to_arrays(res)
 
         self.insert1(key)
 
         # not saving the video in database, just to reduce space requirements
         os.remove(video)
 
+    @staticmethod
+    def results_to_arrays(results):
+        """Convert the per frame CenterHMR outputs into one padded array per field
+
+        Each of the SMPL parameters (body_pose, betas, cam, global_orient) and keypoint
+        outputs (pj2d, j3d, ...) becomes a float32 array of shape (frames, people, ...)
+        padded with NaN, and "counts" holds the number of people in each frame. Results
+        that are already in this format (or entries stored before it) are also accepted,
+        so it can be applied to anything fetched from this table.
+        """
+
+        if isinstance(results, dict):
+            return results
+
+        # move the SMPL parameters up to the same level as the keypoints
+        results = [{**r.get("params", {}), **{k: v for k, v in r.items() if k != "params"}} for r in results]
+
+        counts = np.array([r["body_pose"].shape[0] if "body_pose" in r else 0 for r in results], dtype=np.int16)
+        max_people = int(np.max(counts, initial=0))
+
+        arrays = {"counts": counts}
+        for r in results:
+            for field, value in r.items():
+                if field not in arrays:
+                    arrays[field] = np.full((len(results), max_people, *value.shape[1:]), np.nan, dtype=np.float32)
+
+        for idx, r in enumerate(results):
+            for field, value in r.items():
+                arrays[field][idx, : value.shape[0]] = value
+
+        return arrays
+
 
 @schema
 class CenterHMRPerson(dj.Computed):
@@ -1644,51 +1784,37 @@ class CenterHMRPerson(dj.Computed):
 
         width, height = (VideoInfo & key).fetch1("width", "height")
 
-        def convert_keypoints_to_image(keypoints, imsize=[width, height]):
-            mp = np.array(imsize) * 0.5
-            scale = np.max(np.array(imsize)) * 0.5
-
-            keypoints_image = keypoints * scale + mp
-            return list(keypoints_image)
-
         # fetch data
-        hmr_results = (CenterHMR & key).fetch1("results")
+        hmr_results = CenterHMR.results_to_arrays((CenterHMR & key).fetch1("results"))
         bbox = (PersonBbox & key).fetch1("bbox")
+        counts = hmr_results["counts"]
 
         # get the 2D keypoints. note these are scaled from (-0.5, 0.5) assuming a
-        # square image (hence convert_keypoints_to_image)
-        pj2d = [r["pj2d"] if "pj2d" in r.keys() else np.zeros((0, 25, 2)) for r in hmr_results]
-        all_matches = [
-            match_keypoints_to_bbox(bbox[idx], convert_keypoints_to_image(pj2d[idx]), visible=False)
-            for idx in range(bbox.shape[0])
-        ]
+        # square image, so convert all of them to image coordinates at once
+        pj2d = hmr_results.get("pj2d", np.zeros((len(counts), 0, 25, 2)))
+        mp = np.array([width, height]) * 0.5
+        scale = max(width, height) * 0.5
+        pj2d = pj2d * scale + mp
+
+        keypoints, centerhmr_ids = match_keypoints_to_bbox_batch(
+            bbox, [pj2d[idx, : counts[idx]] for idx in range(bbox.shape[0])], visible=False
+        )
 
-        keypoints, centerhmr_ids = list(zip(*all_matches))
+        # index the matched person in each frame, with unmatched frames left as NaN
+        ids = np.array([-1 if id is None else id for id in centerhmr_ids])
+        matched = np.where(ids >= 0)[0]
 
-        key["poses"] = np.asarray(
-            [
-                res["params"]["body_pose"][id] if id is not None else np.array([np.nan] * 69) * np.nan
-                for res, id in zip(hmr_results, centerhmr_ids)
-            ]
-        )
-        key["betas"] = np.asarray(
-            [
-                res["params"]["betas"][id] if id is not None else np.array([np.nan] * 10) * np.nan
-                for res, id in zip(hmr_results, centerhmr_ids)
-            ]
-        )
-        key["cams"] = np.asarray(
-            [
-                res["params"]["cam"][id] if id is not None else np.array([np.nan] * 3) * np.nan
-                for res, id in zip(hmr_results, centerhmr_ids)
-            ]
-        )
-        key["global_orients"] = np.asarray(
-            [
-                res["params"]["global_orient"][id] if id is not None else np.array([np.nan] * 3) * np.nan
-                for res, id in zip(hmr_results, centerhmr_ids)
-            ]
-        )
+        # kept in the float32 precision of the stored CenterHMR outputs
+        def gather(field, dim):
+            values = np.full((len(ids), dim), np.nan, dtype=np.float32)
+            if len(matched) > 0:
+                values[matched] = hmr_results[field][matched, ids[matched]]
+            return values
+
+        key["poses"] = gather("body_pose", 69)
+        key["betas"] = gather("betas", 10)
+        key["cams"] = gather("cam", 3)
+        key["global_orients"] = gather("global_orient", 3)
 
         key["keypoints"] = np.asarray(keypoints)
         key["centerhmr_ids"] = np.asarray(centerhmr_ids)
@@ -1696,6 +1822,7 @@ class CenterHMRPerson(dj.Computed):
         self.insert1(key)
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def joint_names():
         from smplx.joint_names import JOINT_NAMES
 
@@ -1713,35 +1840,39 @@ class CenterHMRPersonVideo(dj.Computed):
 
     def make(self, key):
 
-        from pose_estimation.util.pyrender_renderer import PyrendererRenderer
-        from pose_estimation.body_models.smpl import SMPL
-        from pose_pipeline.utils.visualization import video_overlay
-
-        # fetch data
-        pose_data = (CenterHMRPerson & key).fetch1()
-        video_filename = (BlurredVideo & key).fetch1("output_video")
-
-        fd, fname = tempfile.mkstemp(suffix=".mp4")
-        os.close(fd)
+        from pose_pipeline.utils.visualization import video_overlay, smpl_vertices, get_smpl, get_smpl_renderer
 
+        # fetch only the fields used for rendering, rather than also deserializing the keypoints
+        global_orients, poses, betas, cams = (CenterHMRPerson & key).fetch1("global_orients", "poses", "betas", "cams")
         video = (BlurredVideo & key).fetch1("output_video")
 
-        smpl = SMPL()
+        # the meshes of the frames with a valid pose are computed in batches as the frames
+        # are reached, keeping only the current batch rather than the whole video in memory
+        body_poses = np.concatenate([global_orients, poses], axis=1)
+        valid = ~np.any(np.isnan(body_poses), axis=1)
+        smpl_idx = np.cumsum(valid) - 1
+        valid_poses = body_poses[valid].astype(float)
+        valid_betas = betas[valid].astype(float)
+        batch_size = 256
+        batch = {"idx": None, "verts": None}
 
         def overlay(image, idx):
-            body_pose = np.concatenate([pose_data["global_orients"][idx], pose_data["poses"][idx]])
-            body_beta = pose_data["betas"][idx]
-
-            if np.any(np.isnan(body_pose)):
+            if not valid[idx]:
                 return image
 
+            # the renderer is cached per process and per frame size, so the closure holds
+            # no state of its own and the table can be populated with parallel_populate
             h, w = image.shape[:2]
-            if overlay.renderer is None:
-                overlay.renderer = PyrendererRenderer(smpl.get_faces(), (h, w))
+            renderer = get_smpl_renderer(h, w)
 
-            verts = smpl(body_pose.astype(float)[None, ...], body_beta.astype(float)[None, ...])[0][0]
+            batch_idx, offset = divmod(smpl_idx[idx], batch_size)
+            if batch["idx"] != batch_idx:
+                frames = slice(batch_idx * batch_size, (batch_idx + 1) * batch_size)
+                batch["verts"] = smpl_vertices(get_smpl(), valid_poses[frames], valid_betas[frames], batch_size)
+                batch["idx"] = batch_idx
+            verts = batch["verts"][offset]
 
-            cam = [pose_data["cams"][idx][0], *pose_data["cams"][idx][:3]]
+            cam = [cams[idx][0], *cams[idx][:3]]
             if h > w:
                 cam[0] = 1.1 ** cam[0] * (h / w)
                 cam[1] = 1.1 ** cam[1]
@@ -1749,13 +1880,12 @@ class CenterHMRPersonVideo(dj.Computed):
                 cam[0] = 1.1 ** cam[0]
                 cam[1] = (1.1 ** cam[1]) * (w / h)
 
-            return overlay.renderer(verts, cam, img=image)
-
-        overlay.renderer = None
+            return renderer(verts, cam, img=image)
 
-        ofd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        ofd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(ofd)
         video_overlay(video, out_file_name, overlay, downsample=4)
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -1803,6 +1933,7 @@ class HumorPersonVideo(dj.Computed):
         from pose_pipeline.wrappers.humor import render_humor
 
         video = render_humor(key)
+        link_to_attach_store(video)
         key["output_video"] = video
 
         self.insert1(key)
@@ -1819,22 +1950,22 @@ class TopDownPersonVideo(dj.Computed):
 
     def make(self, key):
 
-        from pose_pipeline.utils.visualization import video_overlay, draw_keypoints
+        from pose_pipeline.utils.visualization import video_overlay_composite, draw_keypoints, WHITE_RGBA, BLACK_RGBA
 
         video = (BlurredVideo & key).fetch1("output_video")
         keypoints = (TopDownPerson & key).fetch1("keypoints")
 
         bbox_fn = PersonBbox.get_overlay_fn(key)
 
-        def overlay_fn(image, idx):
-            image = draw_keypoints(image, keypoints[idx])
-            image = bbox_fn(image, idx)
-            return image
+        def overlay_fn(canvas, idx):
+            draw_keypoints(canvas, keypoints[idx], color=WHITE_RGBA, border_color=BLACK_RGBA, copy=False)
+            bbox_fn(canvas, idx, color=WHITE_RGBA)
 
-        fd, out_file_name = tempfile.mkstemp(suffix=".mp4")
+        fd, out_file_name = tempfile.mkstemp(suffix=".mp4", dir=get_attach_tempdir())
         os.close(fd)
-        video_overlay(video, out_file_name, overlay_fn, downsample=1)
+        video_overlay_composite(video, out_file_name, overlay_fn, downsample=1)
 
+        link_to_attach_store(out_file_name)
         key["output_video"] = out_file_name
 
         self.insert1(key)
@@ -16,6 +16,30 @@ def keypoints_to_bbox(keypoints, thresh=0.1, min_keypoints=5):
     return bbox
 
 
+def keypoints_to_bboxes(keypoints, thresh=0.1, min_keypoints=5):
+    """Vectorized keypoints_to_bbox for a stack of keypoints with shape (..., J, 2 or 3)
+
+    Returns tlhw boxes with shape (..., 4), which are all zero when fewer than
+    min_keypoints are above thresh.
+    """
+
+    keypoints = np.asarray(keypoints, dtype=float)
+
+    if keypoints.shape[-1] == 3:
+        valid = keypoints[..., -1] > thresh
+        keypoints = keypoints[..., :-1]
+    else:
+        valid = np.ones(keypoints.shape[:-1], dtype=bool)
+
+    tl = np.min(np.where(valid[..., None], keypoints, np.inf), axis=-2)
+    br = np.max(np.where(valid[..., None], keypoints, -np.inf), axis=-2)
+    bbox = np.concatenate([tl, br - tl], axis=-1)
+
+    bbox[np.sum(valid, axis=-1) < min_keypoints] = 0.0
+
+    return bbox
+
+
 def compute_iou(box1: np.ndarray, box2: np.ndarray, tlhw=True, epsilon=1e-8):
     """
     calculate intersection over union cover percent
@@ -57,7 +81,7 @@ def match_keypoints_to_bbox(bbox: np.ndarray, keypoints_list: list, thresh=0.25,
         return empty_keypoints, None
 
     bbox = np.reshape(bbox, (1, 4))
-    kp_bbox = np.array([keypoints_to_bbox(k) for k in keypoints_list])
+    kp_bbox = keypoints_to_bboxes(np.stack(keypoints_list))
 
     iou = compute_iou(bbox, kp_bbox)
     idx = np.argmax(iou)
@@ -66,3 +90,60 @@ def match_keypoints_to_bbox(bbox: np.ndarray, keypoints_list: list, thresh=0.25,
         return keypoints_list[idx], idx
 
     return empty_keypoints, None
+
+
+def match_keypoints_to_bbox_batch(
+    bboxes: np.ndarray, keypoints_list: list, thresh=0.25, num_keypoints=25, visible=True, chunk_size=1024
+):
+    """Vectorized match_keypoints_to_bbox over all the frames of a video
+
+    The frames are matched in chunks of chunk_size. Within a chunk the candidates of
+    every frame are padded to the most people in any frame of that chunk, so the boxes
+    and IoU of all candidates are computed at once while one crowded frame only
+    inflates the memory of its own chunk.
+
+        :param bboxes: person bounding boxes (tlhw) with shape (F, 4)
+        :param keypoints_list: candidate keypoints (C, J, 3 or 2) for each frame, or None
+        :param chunk_size: number of frames matched at once
+        :return: matched keypoints (F, J, 3 or 2), zero where there is no match, and the
+                 list of the matched candidate in each frame (None if no match)
+    """
+
+    counts = np.array([0 if k is None else len(k) for k in keypoints_list], dtype=int)
+    num_frames = len(bboxes)
+
+    if not np.any(counts > 0):
+        return np.zeros((num_frames, num_keypoints, 3 if visible else 2)), [None] * num_frames
+
+    # use the shape of the detected keypoints, which num_keypoints only stands in for
+    shape = np.shape(next(k for k in keypoints_list if k is not None and len(k) > 0))[1:]
+
+    bboxes = np.reshape(bboxes, (num_frames, 4))
+    keypoints = np.zeros((num_frames, *shape))
+    ids = [None] * num_frames
+
+    for start in range(0, num_frames, chunk_size):
+        stop = min(start + chunk_size, num_frames)
+        chunk_counts = counts[start:stop]
+        max_candidates = int(np.max(chunk_counts))
+        if max_candidates == 0:
+            continue
+
+        candidates = np.zeros((stop - start, max_candidates, *shape))
+        for idx in np.where(chunk_counts > 0)[0]:
+            candidates[idx, : chunk_counts[idx]] = keypoints_list[start + idx]
+
+        kp_bbox = keypoints_to_bboxes(candidates)
+        chunk_bboxes = np.repeat(bboxes[start:stop, None], max_candidates, axis=1)
+        iou = compute_iou(chunk_bboxes.reshape(-1, 4), kp_bbox.reshape(-1, 4)).reshape(stop - start, max_candidates)
+
+        # padding is never matched
+        iou[np.arange(max_candidates)[None, :] >= chunk_counts[:, None]] = -np.inf
+
+        best = np.argmax(iou, axis=1)
+        matched = iou[np.arange(stop - start), best] > thresh
+
+        keypoints[start:stop][matched] = candidates[matched, best[matched]]
+        ids[start:stop] = [int(b) if m else None for b, m in zip(best, matched)]
+
+    return keypoints, ids
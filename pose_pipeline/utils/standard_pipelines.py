@@ -1,3 +1,4 @@
+import os
 from pose_pipeline import *
 from pose_pipeline.utils.tracking import annotate_single_person
 from typing import List, Dict, Union
@@ -338,3 +339,83 @@ def blur_videos(keys: Union[Dict, List[Dict]], reserve_jobs: bool = False):
         # handle the case where some of the jobs where reserved
         if len(BottomUpPeople & key) > 0:
             BlurredVideo.populate(key, reserve_jobs=reserve_jobs)
+
+
+def _init_populate_worker(gpu_queue):
+    """Pin a populate worker to a single GPU, if one was provided, and limit OpenCV threads"""
+
+    import cv2
+
+    if gpu_queue is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_queue.get())
+
+    # the workers already run in parallel, so keep OpenCV from also starting a thread pool
+    # per process that competes with the CPU threads of the networks
+    cv2.setNumThreads(1)
+
+
+def _populate_key(table_class, key: Dict, reserve_jobs: bool):
+    # the class pickles by its qualified name, so the worker imports the module defining it
+    table_class().populate(key, reserve_jobs=reserve_jobs)
+
+
+def parallel_populate(
+    table,
+    keys: List[Dict] = None,
+    processes: int = 4,
+    gpus: List[int] = None,
+    reserve_jobs: bool = True,
+):
+    """
+    Populate a table with each key computed in a separate worker process.
+
+    Every key processes an independent video, so decode and render bound tables
+    (e.g. BlurredVideo, TrackingBboxVideo, CenterHMRPersonVideo) scale with the number
+    of workers. Each worker is limited to one OpenMP thread to avoid oversubscribing
+    the CPU. Workers are spawned rather than forked, so each one creates its own CUDA
+    and offscreen GL contexts.
+
+    Args:
+        table (dj.Computed)         : table to populate. must be defined in an importable module
+        keys (list of dict)         : keys to compute. defaults to all keys not yet computed
+        processes (int)             : number of worker processes. ignored if gpus are provided
+        gpus (list of int)          : run one worker per GPU, pinned with CUDA_VISIBLE_DEVICES
+        reserve_jobs (bool)         : whether to reserve jobs or not
+    """
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if isinstance(table, type):
+        table = table()
+
+    if keys is None:
+        keys = (table.key_source - table).fetch("KEY")
+    elif isinstance(keys, dict):
+        keys = [keys]
+
+    # spawn so workers open their own database connection instead of sharing the parent's
+    ctx = multiprocessing.get_context("spawn")
+
+    gpu_queue = None
+    if gpus is not None:
+        processes = len(gpus)
+        gpu_queue = ctx.Queue()
+        for gpu in gpus:
+            gpu_queue.put(gpu)
+
+    # workers inherit the environment when spawned, before numpy or torch are imported
+    omp_num_threads = os.environ.get("OMP_NUM_THREADS")
+    os.environ["OMP_NUM_THREADS"] = "1"
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=ctx, initializer=_init_populate_worker, initargs=(gpu_queue,)
+        ) as executor:
+            futures = [executor.submit(_populate_key, table.__class__, key, reserve_jobs) for key in keys]
+            for future in futures:
+                future.result()
+    finally:
+        if omp_num_threads is None:
+            os.environ.pop("OMP_NUM_THREADS")
+        else:
+            os.environ["OMP_NUM_THREADS"] = omp_num_threads
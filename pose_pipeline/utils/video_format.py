@@ -1,6 +1,13 @@
-from pose_pipeline.pipeline import Video
+from pose_pipeline.pipeline import Video, schema
+from contextlib import contextmanager
+import datajoint as dj
 import subprocess
+import json
+import queue
+import hashlib
+import threading
 import tempfile
+import shutil
 import os
 
 
@@ -27,3 +34,260 @@ def insert_local_video(filename, video_start_time, local_path, video_project="TE
 
     print(vid_struct)
     Video().insert1(vid_struct, skip_duplicates=skip_duplicates)
+
+
+def open_video_capture(video):
+    """Open a video for decoding with the FFmpeg backend
+
+    Selecting the backend explicitly avoids probing the others on open. Hardware
+    accelerated decoding is requested where OpenCV supports it and otherwise it
+    silently falls back to software decoding. Frames are always read sequentially,
+    so no more than one frame needs to be buffered.
+
+    Args:
+        video (str): filename of the video
+
+    Returns:
+        cv2.VideoCapture
+    """
+    import cv2
+
+    if hasattr(cv2, "CAP_PROP_HW_ACCELERATION"):
+        cap = cv2.VideoCapture(video, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    else:
+        cap = cv2.VideoCapture(video, cv2.CAP_FFMPEG)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+
+def prefetch_frames(cap, num_frames=None, buffer_size=8):
+    """Yield the BGR frames of an opened capture while the following ones decode in a thread
+
+    OpenCV releases the GIL while decoding, so the next frames are decoded while the
+    caller processes the current one. At most buffer_size decoded frames are queued.
+
+    Args:
+        cap (cv2.VideoCapture): opened capture, read from its current position
+        num_frames (int, optional): stop after this many frames
+        buffer_size (int): number of decoded frames to queue
+    """
+
+    frames = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def decode():
+        try:
+            count = 0
+            while num_frames is None or count < num_frames:
+                ret, frame = cap.read()
+                if not ret or frame is None:
+                    break
+                put(frame)
+                count += 1
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            yield frame
+    finally:
+        # release the decoder if the caller stopped early
+        stop.set()
+        thread.join()
+
+
+def probe_video(video):
+    """Read the fps, frame count, width and height of a video from the container metadata
+
+    This uses ffprobe so no decoder needs to be opened. The values match what OpenCV
+    reports for the decoded frames: the size is swapped for videos with a 90 degree
+    rotation (e.g. portrait phone videos), which OpenCV rotates when decoding, and the
+    fps is the average frame rate. Containers that do not record the number of frames
+    (e.g. mkv or webm) get it from the duration, as OpenCV does. Only when ffprobe is
+    not available or fails does it fall back to OpenCV.
+
+    Args:
+        video (str): filename of the video
+
+    Returns:
+        fps (float), num_frames (int), width (int), height (int)
+    """
+
+    try:
+        out = subprocess.check_output(
+            [
+                "ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-show_entries",
+                "stream=nb_frames,width,height,avg_frame_rate,r_frame_rate,duration"
+                ":stream_tags=rotate:stream_side_data=rotation:format=duration",
+                "-of", "json",
+                video,
+            ]
+        )
+        info = json.loads(out)
+        stream = info["streams"][0]
+
+        # variable frame rate videos only have a meaningful average rate
+        frame_rate = stream.get("avg_frame_rate", "0/0")
+        if frame_rate == "0/0":
+            frame_rate = stream["r_frame_rate"]
+        num, den = frame_rate.split("/")
+        fps = float(num) / float(den)
+
+        if stream.get("nb_frames", "N/A") != "N/A":
+            num_frames = int(stream["nb_frames"])
+        else:
+            duration = stream.get("duration", "N/A")
+            if duration == "N/A":
+                duration = info["format"]["duration"]
+            num_frames = int(round(float(duration) * fps))
+
+        # the rotation is a display matrix in the side data in newer ffmpeg and a tag in older ones
+        rotation = stream.get("tags", {}).get("rotate", 0)
+        for side_data in stream.get("side_data_list", []):
+            if "rotation" in side_data:
+                rotation = side_data["rotation"]
+
+        width, height = int(stream["width"]), int(stream["height"])
+        if int(float(rotation)) % 180 == 90:
+            width, height = height, width
+
+        return fps, num_frames, width, height
+    except (OSError, subprocess.CalledProcessError, KeyError, IndexError, ValueError, ZeroDivisionError):
+        import cv2
+
+        cap = open_video_capture(video)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+        return fps, num_frames, width, height
+
+
+def get_video_cache_dir():
+    """Directory for the local cache of downloaded videos. Set with dj.config['custom']['video_cache_dir']"""
+    default = os.path.join(os.path.expanduser("~"), ".cache", "pose_pipeline", "videos")
+    return dj.config.get("custom", {}).get("video_cache_dir", default)
+
+
+def evict_video_cache(cache_dir, max_size_gb, keep=None):
+    """Remove the least recently used videos, other than keep, until the cache is under max_size_gb"""
+
+    files = []
+    for root, dirs, filenames in os.walk(cache_dir):
+        # skip the directories used for in progress downloads
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        files.extend([os.path.join(root, f) for f in filenames])
+
+    # other processes may evict the same files concurrently, so skip any that vanish
+    stats = {}
+    for f in files:
+        try:
+            stats[f] = os.stat(f)
+        except FileNotFoundError:
+            continue
+
+    total_size = sum(st.st_size for st in stats.values())
+    files = sorted([f for f in stats if f != keep], key=lambda f: stats[f].st_mtime)
+    while total_size > max_size_gb * 1e9 and len(files) > 0:
+        f = files.pop(0)
+        total_size -= stats[f].st_size
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            continue
+
+
+def _video_identity(key):
+    """Identifier of the attachment stored for a Video entry
+
+    This changes when the entry is deleted and inserted again, even under the same
+    primary key, so a cached copy of a replaced video is never used. It combines the
+    import time with the hash and size of the attachment in the external store.
+    """
+
+    import_time = (Video & key).fetch1("import_time")
+    identity = str(import_time)
+    try:
+        external = schema.external["localattach"]
+        # join on the uuid the entry stores for the attachment, without downloading it
+        uuid, size = (external * Video.proj(hash="video") & key).fetch1("hash", "size")
+        identity += f"-{uuid}-{size}"
+    except dj.DataJointError:
+        pass
+
+    return hashlib.sha1(identity.encode()).hexdigest()[:16]
+
+
+def _verified_marker(key):
+    """Marker file recording that every frame of the video stored for key is readable"""
+
+    video_project, filename = (Video & key).fetch1("video_project", "filename")
+    name = hashlib.sha1(f"{video_project}\0{filename}\0{_video_identity(key)}".encode()).hexdigest()
+    return os.path.join(get_video_cache_dir(), ".verified", name)
+
+
+def is_video_verified(key):
+    """Check if every frame of the video stored for key was already found to be readable"""
+    return os.path.exists(_verified_marker(key))
+
+
+def mark_video_verified(key):
+    """Record that every frame of the video stored for key is readable, so it does not need checking again"""
+
+    marker = _verified_marker(key)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    open(marker, "w").close()
+
+
+@contextmanager
+def cached_video(key):
+    """Provide a local path to the source video for a key
+
+    The attach is only downloaded from the store the first time the video is used.
+    Afterwards it is served from a local least recently used cache limited to
+    dj.config['custom']['video_cache_size'] GB (default 50), so downstream tables
+    sharing a video do not download it again. Cached copies are keyed by the identity
+    of the stored attachment, so a video that was re-inserted is downloaded again.
+    The file belongs to the cache and must not be moved or removed by the caller.
+
+    Args:
+        key (dict): key restricting Video to a single entry
+    """
+
+    video_project, filename = (Video & key).fetch1("video_project", "filename")
+
+    cache_dir = get_video_cache_dir()
+    path = os.path.join(cache_dir, video_project, _video_identity(key), filename)
+
+    if os.path.exists(path):
+        # mark as recently used
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        download_dir = tempfile.mkdtemp(prefix=".download", dir=cache_dir)
+        try:
+            video = (Video & key).fetch1("video", download_path=download_dir)
+            os.replace(video, path)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+        evict_video_cache(cache_dir, dj.config.get("custom", {}).get("video_cache_size", 50), keep=path)
+
+    yield path
@@ -1,14 +1,45 @@
 import os
 import cv2
-import tempfile
-import shutil
+import queue
+import threading
 import subprocess
 import numpy as np
 from tqdm import tqdm
+from functools import lru_cache
 
 from pose_pipeline import VideoInfo, PersonBbox, SMPLPerson, TopDownPerson, TopDownPersonVideo
 
 
+def h264_encoder_args(encoder, bitrate="5M"):
+    """ffmpeg output arguments to encode H.264 with the fastest preset of encoder"""
+    preset = "p1" if encoder == "h264_nvenc" else "ultrafast"
+    return ["-c:v", encoder, "-preset", preset, "-pix_fmt", "yuv420p", "-b:v", bitrate]
+
+
+@lru_cache(maxsize=None)
+def get_h264_encoder():
+    """Use the NVENC H.264 encoder when it works on this host, otherwise libx264
+
+    Many ffmpeg builds list h264_nvenc even without a usable GPU or driver, so this
+    encodes a few blank frames with it, using the same preset and rate control as
+    the overlay videos, rather than only checking the encoder list.
+    """
+
+    try:
+        test = subprocess.run(
+            [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+                *h264_encoder_args("h264_nvenc"), "-f", "null", "-",
+            ],
+            capture_output=True,
+        )
+    except OSError:
+        return "libx264"
+
+    return "h264_nvenc" if test.returncode == 0 else "libx264"
+
+
 def video_overlay(
     video,
     output_name,
@@ -19,16 +50,30 @@ def video_overlay(
     compress=True,
     bitrate="5M",
     max_frames=None,
+    encoder=None,
 ):
     """Process a video and create overlay image
 
+    When compressing, the overlaid RGB frames are piped straight into ffmpeg, which
+    encodes them with the fastest preset of the H.264 encoder directly into output_name
+    without an intermediate file.
+
+    Decoding and writing the frames run in background threads with a few frames in
+    flight, so they overlap with the callback. The callback itself is always called
+    in order from the calling thread, as renderers hold thread bound GL contexts.
+
     Args:
         video (str): filename for source
         output_name (str): output filename
         callback (fn(im, idx) -> im): method to overlay frame
+        encoder (str, optional): ffmpeg H.264 encoder. defaults to h264_nvenc when available, else libx264.
+            if an h264_nvenc encode fails (e.g. when the GPU has no free encoder sessions)
+            the video is made again with libx264
     """
 
-    cap = cv2.VideoCapture(video)
+    from pose_pipeline.utils.video_format import open_video_capture
+
+    cap = open_video_capture(video)
 
     # get info
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -39,8 +84,25 @@ def video_overlay(
     # configure output
     output_size = (int(w / downsample), int(h / downsample))
 
-    fourcc = cv2.VideoWriter_fourcc(*codec)
-    out = cv2.VideoWriter(output_name, fourcc, fps, output_size)
+    if compress:
+        if encoder is None:
+            encoder = get_h264_encoder()
+
+        out = subprocess.Popen(
+            [
+                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{output_size[0]}x{output_size[1]}", "-r", str(fps),
+                "-i", "-",
+                *h264_encoder_args(encoder, bitrate),
+                # put the index at the start so the stored videos can be streamed
+                "-movflags", "+faststart",
+                output_name,
+            ],
+            stdin=subprocess.PIPE,
+        )
+    else:
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+        out = cv2.VideoWriter(output_name, fourcc, fps, output_size)
 
     if blur_faces:
         blur = FaceBlur()
@@ -48,59 +110,241 @@ def video_overlay(
     if max_frames:
         total_frames = max_frames
 
-    for idx in tqdm(range(total_frames)):
+    frames = queue.Queue(maxsize=8)
+    out_frames = queue.Queue(maxsize=8)
+    stop = threading.Event()
+    errors = []
+
+    # queue operations that give up once any of the threads stopped, rather than blocking forever
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def decode():
+        try:
+            for _ in range(total_frames):
+                ret, frame = cap.read()
+                if not ret or frame is None:
+                    break
+
+                # process image in RGB format
+                put(frames, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(frames, None)
+
+    def encode():
+        try:
+            while True:
+                out_frame = get(out_frames)
+                if out_frame is None:
+                    break
+
+                if compress:
+                    # ffmpeg takes the RGB frame as is
+                    out.stdin.write(memoryview(np.ascontiguousarray(out_frame)).cast("B"))
+                else:
+                    # move back to BGR format and write to movie
+                    out.write(cv2.cvtColor(out_frame, cv2.COLOR_RGB2BGR))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    decoder = threading.Thread(target=decode, daemon=True)
+    encoder_thread = threading.Thread(target=encode, daemon=True)
+    decoder.start()
+    encoder_thread.start()
+
+    failed = True
+    try:
+        for idx in tqdm(range(total_frames)):
+
+            frame = get(frames)
+            if frame is None:
+                break
+
+            out_frame = callback(frame, idx)
+
+            if blur_faces:
+                out_frame = blur(out_frame)
+
+            if out_frame.shape[:2] != output_size[::-1]:
+                out_frame = cv2.resize(out_frame, output_size)
+
+            put(out_frames, out_frame)
+        failed = False
+    finally:
+        put(out_frames, None)
+        encoder_thread.join()
+        stop.set()
+        decoder.join()
+
+        # release the decoder and encoder even when the callback raised, so no ffmpeg
+        # process is left waiting on its input
+        cap.release()
+        if compress:
+            if failed:
+                out.kill()
+            try:
+                out.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = out.wait()
+        else:
+            out.release()
 
-        ret, frame = cap.read()
-        if not ret or frame is None:
-            break
+    if compress and returncode != 0:
+        if encoder == "h264_nvenc":
+            return video_overlay(
+                video, output_name, callback, downsample, codec, blur_faces, compress, bitrate, max_frames, "libx264"
+            )
+        raise Exception(f"ffmpeg failed to encode {output_name}")
 
-        # process image in RGB format
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        out_frame = callback(frame, idx)
+    if len(errors) > 0:
+        raise errors[0]
 
-        if blur_faces:
-            out_frame = blur(out_frame)
 
-        # move back to BGR format and write to movie
-        out_frame = cv2.cvtColor(out_frame, cv2.COLOR_RGB2BGR)
-        out_frame = cv2.resize(out_frame, output_size)
-        out.write(out_frame)
+# opaque colors for drawing on the RGBA canvas of video_overlay_composite
+WHITE_RGBA = (255, 255, 255, 255)
+BLACK_RGBA = (0, 0, 0, 255)
 
-    out.release()
-    cap.release()
 
-    if compress:
-        fd, temp = tempfile.mkstemp(suffix=".mp4")
-        subprocess.run(["ffmpeg", "-y", "-i", output_name, "-c:v", "libx264", "-b:v", bitrate, temp])
-        os.close(fd)
-        shutil.move(temp, output_name)
-
-
-def draw_keypoints(image, keypoints, radius=10, threshold=0.2, color=(255, 255, 255), border_color=(0, 0, 0)):
-    """Draw the keypoints on an image"""
-    image = image.copy()
-    keypoints = keypoints.copy()
-    keypoints[..., 0] = np.clip(keypoints[..., 0], 0, image.shape[1])
-    keypoints[..., 1] = np.clip(keypoints[..., 1], 0, image.shape[0])
-    for i in range(keypoints.shape[0]):
-        if keypoints[i, -1] > threshold:
-            cv2.circle(image, (int(keypoints[i, 0]), int(keypoints[i, 1])), radius, border_color, -1)
-            if radius > 2:
-                cv2.circle(image, (int(keypoints[i, 0]), int(keypoints[i, 1])), radius - 2, color, -1)
+def video_overlay_composite(video, output_name, callback, downsample=1, bitrate="5M", encoder=None):
+    """Draw overlays on a transparent layer and let ffmpeg composite them onto a video
+
+    Unlike video_overlay, the source frames are never decoded into Python. The callback
+    draws onto a cleared RGBA canvas (using colors with an alpha of 255, such as
+    WHITE_RGBA and BLACK_RGBA), which is piped to ffmpeg and composited over the video
+    it decodes itself, in one decode and encode. This suits any overlay that does not
+    depend on the underlying pixels, such as keypoints, boxes and labels.
+
+    Args:
+        video (str): filename for source
+        output_name (str): output filename
+        callback (fn(canvas, idx)): method to draw the overlay of a frame into canvas
+        encoder (str, optional): ffmpeg H.264 encoder. defaults to h264_nvenc when available, else libx264.
+            a failed h264_nvenc encode is made again with libx264
+    """
+
+    from pose_pipeline.utils.video_format import probe_video
+
+    fps, total_frames, w, h = probe_video(video)
+    output_size = (int(w / downsample), int(h / downsample))
+
+    if encoder is None:
+        encoder = get_h264_encoder()
+
+    # both streams start from zero so the overlay frames line up with the video frames
+    filter_graph = (
+        "[0:v]setpts=PTS-STARTPTS[bg];[1:v]setpts=PTS-STARTPTS[fg];"
+        f"[bg][fg]overlay=shortest=1,scale={output_size[0]}:{output_size[1]}[out]"
+    )
+
+    out = subprocess.Popen(
+        [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-i", video,
+            "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{w}x{h}", "-r", str(fps), "-i", "-",
+            "-filter_complex", filter_graph, "-map", "[out]",
+            *h264_encoder_args(encoder, bitrate),
+            "-movflags", "+faststart",
+            output_name,
+        ],
+        stdin=subprocess.PIPE,
+    )
+
+    canvas = np.zeros((h, w, 4), dtype=np.uint8)
+    failed = True
+    try:
+        for idx in tqdm(range(total_frames)):
+            canvas[:] = 0
+            callback(canvas, idx)
+            out.stdin.write(memoryview(canvas).cast("B"))
+        failed = False
+    except BrokenPipeError:
+        # ffmpeg stops reading once the video has no more frames
+        failed = False
+    finally:
+        # stop ffmpeg rather than leave it waiting on its input if the callback raised
+        if failed:
+            out.kill()
+        try:
+            out.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = out.wait()
+
+    if returncode != 0:
+        if encoder == "h264_nvenc":
+            return video_overlay_composite(video, output_name, callback, downsample, bitrate, "libx264")
+        raise Exception(f"ffmpeg failed to encode {output_name}")
+
+
+def draw_keypoints(image, keypoints, radius=10, threshold=0.2, color=(255, 255, 255), border_color=(0, 0, 0), copy=True):
+    """Draw the keypoints on an image, or directly into it if copy is False"""
+    if copy:
+        image = image.copy()
+
+    # select, clip and integerize the visible joints in one pass so only the drawing is per joint
+    visible = keypoints[keypoints[:, -1] > threshold]
+    x = np.clip(visible[:, 0], 0, image.shape[1]).astype(np.int32)
+    y = np.clip(visible[:, 1], 0, image.shape[0]).astype(np.int32)
+    for center in zip(x.tolist(), y.tolist()):
+        cv2.circle(image, center, radius, border_color, -1)
+        if radius > 2:
+            cv2.circle(image, center, radius - 2, color, -1)
     return image
 
 
-def get_smpl_callback(key, poses, betas, cams):
+@lru_cache(maxsize=1)
+def get_smpl():
+    """SMPL body model, loaded once per process rather than for every video"""
     from pose_estimation.body_models.smpl import SMPL
+
+    return SMPL()
+
+
+@lru_cache(maxsize=4)
+def get_smpl_renderer(height, width):
+    """SMPL mesh renderer for a frame size, kept so the offscreen GL context is reused across videos"""
     from pose_estimation.util.pyrender_renderer import PyrendererRenderer
 
+    return PyrendererRenderer(get_smpl().get_faces(), img_size=(height, width))
+
+
+def smpl_vertices(smpl, poses, betas, batch_size=256):
+    """Compute the SMPL mesh vertices for all frames, batch_size frames per forward pass
+
+    The vertices are kept as float32, which is plenty for rendering and halves the
+    memory held for the meshes of a whole video.
+    """
+
+    verts = [
+        smpl(poses[i : i + batch_size], betas[i : i + batch_size])[0].numpy().astype(np.float32, copy=False)
+        for i in range(0, len(poses), batch_size)
+    ]
+    return np.concatenate(verts, axis=0)
+
+
+def get_smpl_callback(key, poses, betas, cams):
     height, width = (VideoInfo & key).fetch1("height", "width")
 
     valid_idx = np.where((PersonBbox & key).fetch1("present"))[0]
 
-    smpl = SMPL()
-    renderer = PyrendererRenderer(smpl.get_faces(), img_size=(height, width))
-    verts = smpl(poses, betas)[0].numpy()
+    renderer = get_smpl_renderer(height, width)
+    verts = smpl_vertices(get_smpl(), poses, betas)
 
     joints2d = (SMPLPerson & key).fetch1("joints2d")
 
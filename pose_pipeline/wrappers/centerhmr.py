@@ -59,17 +59,16 @@ def centerhmr_parse_video(video_path, centerhmr_python_path, output_video_path=N
 
         def process_video(self, video_file_path=None, output_file_name=None):
 
-            cap = cv2.VideoCapture(video_file_path)
+            from pose_pipeline.utils.video_format import open_video_capture, prefetch_frames
+
+            cap = open_video_capture(video_file_path)
             video_length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
             fps = cap.get(cv2.CAP_PROP_FPS)
             results = []
             writer = None
 
-            for frame_id in tqdm(range(video_length)):
-
-                ret, frame = cap.read()
-                if frame is None:
-                    break
+            # the following frames are decoded while the network runs on the current one
+            for frame in tqdm(prefetch_frames(cap, video_length), total=video_length):
 
                 with torch.no_grad():
                     outputs = self.single_image_forward(frame[:, :, ::-1])
@@ -105,6 +104,7 @@ def centerhmr_parse_video(video_path, centerhmr_python_path, output_video_path=N
 
             if writer is not None:
                 writer.release()
+            cap.release()
 
             return results
 
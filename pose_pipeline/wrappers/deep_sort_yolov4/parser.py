@@ -20,7 +20,9 @@ from .tools import generate_detections as gdet
 
 def tracking_bounding_boxes(file_path, outfile=None):
 
-    video_capture = cv2.VideoCapture(file_path)
+    from pose_pipeline.utils.video_format import open_video_capture
+
+    video_capture = open_video_capture(file_path)
     w = int(video_capture.get(3))
     h = int(video_capture.get(4))
     fps = video_capture.get(cv2.CAP_PROP_FPS)
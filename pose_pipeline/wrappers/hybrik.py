@@ -36,7 +36,7 @@ def finalize_dict(accumulator, accumulated_frames, num_frames):
         if type(accumulator[k]) == dict:
             clean_dict[k] = finalize_dict(accumulator[k], accumulated_frames, num_frames)
         else:
-            clean_dict[k] = np.zeros((num_frames, *accumulator[k].shape[1:])) * np.nan
+            clean_dict[k] = np.full((num_frames, *accumulator[k].shape[1:]), np.nan)
             clean_dict[k][found_ids] = accumulator[k]
 
     return clean_dict
@@ -23,7 +23,7 @@ mmpose_joint_dictionary = {
                    "Left Hip", "Right Hip", "Left Knee", "Right Knee", "Left Ankle", "Right Ankle"]
 }
 
-def mmpose_top_down_person(key, method='HRNet_W48_COCO'):
+def mmpose_top_down_person(key, method='HRNet_W48_COCO', fp16=False):
 
     from mmpose.apis import init_pose_model, inference_top_down_pose_model
     from tqdm import tqdm
@@ -51,34 +51,46 @@ def mmpose_top_down_person(key, method='HRNet_W48_COCO'):
         pose_ckpt = os.path.join(MODEL_DATA_DIR, 'mmpose/checkpoints/hrnet_w48_halpe_384x288_dark_plus-d13c2588_20211021.pth')
         num_keypoints = 136
     bboxes = (PersonBbox & key).fetch1("bbox")
+    from pose_pipeline.utils.video_format import open_video_capture
+
     video =  Video.get_robust_reader(key, return_cap=False) # returning video allows deleting it
-    cap = cv2.VideoCapture(video)
+    cap = open_video_capture(video)
 
     model = init_pose_model(pose_cfg, pose_ckpt)
+    if fp16:
+        # run the network under mixed precision. mmpose crops and normalizes each
+        # bounding box itself, so only the model needs converting
+        from mmcv.runner import wrap_fp16_model
 
-    results = []
-    for bbox in tqdm(bboxes):
+        wrap_fp16_model(model)
 
-        # should match the length of identified person tracks
-        ret, frame = cap.read()
-        assert ret and frame is not None
+    # frames without a person are left as zeros
+    results = np.zeros((len(bboxes), num_keypoints, 3), dtype=np.float32)
+    for idx, bbox in enumerate(tqdm(bboxes)):
+
+        # should match the length of identified person tracks. only advance the
+        # stream here so frames without a person are never fully decoded
+        ret = cap.grab()
+        assert ret
 
         # handle the case where person is not tracked in frame
-        if np.any(np.isnan(bbox)):
-            results.append(np.zeros((num_keypoints, 3)))
+        if np.any(np.isnan(bbox)) or bbox[2] <= 0 or bbox[3] <= 0:
             continue
 
+        ret, frame = cap.retrieve()
+        assert ret and frame is not None
+
         bbox_wrap = {"bbox": bbox}
 
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
         res = inference_top_down_pose_model(model, frame, [bbox_wrap])[0]
-        results.append(res[0]["keypoints"])
+        results[idx] = res[0]["keypoints"]
 
     cap.release()
     os.remove(video)
 
-    return np.asarray(results)
+    return results
 
 
 def mmpose_bottom_up(key):
@@ -96,8 +108,10 @@ def mmpose_bottom_up(key):
 
     model = init_pose_model(pose_cfg, pose_ckpt)
 
+    from pose_pipeline.utils.video_format import open_video_capture
+
     video = Video.get_robust_reader(key, return_cap=False)
-    cap = cv2.VideoCapture(video)
+    cap = open_video_capture(video)
 
     video_length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
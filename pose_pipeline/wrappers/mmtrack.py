@@ -29,7 +29,9 @@ def mmtrack_bounding_boxes(file_path, method="tracktor"):
         raise Exception(f"Unknown config file for MMTrack method {method}")
     model = mmtrack.apis.init_model(model_config)
 
-    cap = cv2.VideoCapture(file_path)
+    from pose_pipeline.utils.video_format import open_video_capture
+
+    cap = open_video_capture(file_path)
     video_length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
     tracks = []
@@ -127,11 +127,20 @@ class OpenposeParser:
 
 
 def openpose_parse_video(video_file, **kwargs):
+    """Run OpenPose on every frame of a video
+
+    Args:
+        video_file (str or cv2.VideoCapture): filename, or an already opened capture
+            which is read from its current position and left for the caller to release
+    """
 
     op = OpenposeParser(render=False, **kwargs)
     results = []
 
-    cap = cv2.VideoCapture(video_file)
+    from pose_pipeline.utils.video_format import open_video_capture
+
+    own_cap = not isinstance(video_file, cv2.VideoCapture)
+    cap = open_video_capture(video_file) if own_cap else video_file
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
     for _ in tqdm(range(total_frames)):
@@ -149,7 +158,8 @@ def openpose_parse_video(video_file, **kwargs):
     op.stop()
     del op
 
-    cap.release()
+    if own_cap:
+        cap.release()
 
     return results
 